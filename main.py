@@ -1,170 +1,395 @@
 import streamlit as st
-from huggingface_hub import InferenceClient
-from PIL import Image
+from PIL import Image, ImageOps, UnidentifiedImageError
 import io
-import pandas as pd
+import hashlib
+from operator import itemgetter
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Load Hugging Face API key from .env. Once found it stays in os.environ, so .env
+# is only re-read while the key is missing and adding it needs no restart.
+def hf_token():
+    token = os.getenv("HUGGINGFACE_API_KEY")
+    if not token:
+        load_dotenv()
+        token = os.getenv("HUGGINGFACE_API_KEY")
+    return token
+
+# Hugging Face models, run locally when possible and through the API otherwise
+AGE_MODEL = "nateraw/vit-age-classifier"
+DETECTOR_MODEL = "umm-maybe/AI-image-detector"
+
+def api_url(model):
+    return f"https://api-inference.huggingface.co/models/{model}"
+
+# Shared session so TCP/TLS connections are reused across calls and reruns
+@st.cache_resource
+def get_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=64,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["POST"],
+            # Hand the final 429/5xx response to raise_for_status instead of raising RetryError
+            raise_on_status=False,
+        ),
+    )
+    session.mount("https://", adapter)
+    return session
+
+# Longest edge sent to the API; the models only see a few hundred pixels anyway
+MAX_IMAGE_SIDE = 512
+
+def _prepare_payload(image_bytes, max_side=MAX_IMAGE_SIDE, quality=85):
+    # Downscale and re-encode as JPEG so uploads stay small
+    image = Image.open(io.BytesIO(image_bytes))
+    # For JPEGs, let libjpeg decode straight at a reduced DCT scale
+    image.draft('RGB', (max_side, max_side))
+    # Re-encoding drops EXIF, so apply the Orientation tag to the pixels first
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((max_side, max_side), Image.Resampling.BILINEAR)
+    image = image.convert('RGB')
 
-# Load Hugging Face API key from .env
-load_dotenv()
-HF_TOKEN = os.getenv("HUGGINGFACE_API_KEY")
+    # No optimize=True: the extra Huffman pass costs more than the bytes it saves
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', optimize=False, quality=quality, progressive=False)
+    return buffer.getvalue()
 
-# Hugging Face API details for AI image detector
-API_URL_DETECTOR = "https://api-inference.huggingface.co/models/umm-maybe/AI-image-detector"
-headers = {"Authorization": f"Bearer {HF_TOKEN}"}
+TOKEN_MISSING_MESSAGE = "Hugging Face API token not found! Please set HUGGINGFACE_API_KEY in your .env file."
 
-def query_age(image):
-    image = image.convert('RGB')
-    image_bytes = io.BytesIO()
-    image.save(image_bytes, format='JPEG')
-    image_bytes.seek(0)
-
-    response = requests.post(
-        "https://api-inference.huggingface.co/models/nateraw/vit-age-classifier",
-        headers=headers,
-        data=image_bytes.getvalue()
+class MissingTokenError(RuntimeError):
+    """Raised when the API is needed but no Hugging Face token is configured."""
+
+class BadResponse(ValueError):
+    """Base for API responses that can't be used; keeps the raw body in .text."""
+
+    def __init__(self, text):
+        super().__init__(text)
+        self.text = text
+
+class NonJSONResponse(BadResponse):
+    """Raised when the API answers with something other than JSON."""
+
+class UnexpectedResponse(BadResponse):
+    """Raised when the API returns JSON that is not a list of label/score results."""
+
+def _is_classification(result):
+    return (
+        isinstance(result, list)
+        and len(result) > 0
+        and all(isinstance(item, dict) and 'label' in item and 'score' in item for item in result)
     )
 
+# Load models as int8 (bitsandbytes on GPU, ONNX Runtime on CPU) when the extra
+# packages are available; otherwise the regular float pipeline is used
+QUANTIZE_MODELS = True
+ONNX_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".onnx_cache")
+
+def _load_int8_pipeline(model, use_cuda):
+    from transformers import AutoImageProcessor, pipeline
+
+    processor = AutoImageProcessor.from_pretrained(model)
+
+    if use_cuda:
+        from transformers import AutoModelForImageClassification, BitsAndBytesConfig
+
+        quantized = AutoModelForImageClassification.from_pretrained(
+            model,
+            quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+            device_map="auto",
+        )
+        return pipeline("image-classification", model=quantized, image_processor=processor)
+
+    from optimum.onnxruntime import ORTModelForImageClassification
+
+    # Export and quantize once, then reuse the int8 file on later starts
+    save_dir = os.path.join(ONNX_CACHE_DIR, model.replace("/", "--"))
+    int8_file = "model.int8.onnx"
+    if not os.path.exists(os.path.join(save_dir, int8_file)):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        ORTModelForImageClassification.from_pretrained(model, export=True).save_pretrained(save_dir)
+        # Quantize to a temporary file and rename it into place, so an interrupted
+        # run never leaves a half-written int8 model that later starts would reuse
+        tmp_path = os.path.join(save_dir, "model.int8.tmp.onnx")
+        quantize_dynamic(
+            os.path.join(save_dir, "model.onnx"),
+            tmp_path,
+            weight_type=QuantType.QUInt8,
+        )
+        os.replace(tmp_path, os.path.join(save_dir, int8_file))
+
+    quantized = ORTModelForImageClassification.from_pretrained(save_dir, file_name=int8_file)
+    return pipeline("image-classification", model=quantized, image_processor=processor)
+
+# Loaded once per process and shared by all sessions. Returns None when
+# transformers/torch are missing or the download fails, so callers fall back to the API.
+@st.cache_resource(show_spinner="Loading model...")
+def get_pipeline(model):
     try:
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        st.error(f"Error contacting Hugging Face: {e}")
+        import torch
+        from transformers import pipeline
+    except ImportError:
         return None
-    except ValueError:
-        st.error("Error decoding JSON:")
-        st.text(response.text)
+
+    use_cuda = torch.cuda.is_available()
+
+    if QUANTIZE_MODELS:
+        try:
+            return _load_int8_pipeline(model, use_cuda)
+        except Exception:
+            logger.exception("Loading %s as int8 failed, using the float model", model)
+
+    try:
+        return pipeline(
+            "image-classification",
+            model=model,
+            device=0 if use_cuda else -1,
+            torch_dtype=torch.float16 if use_cuda else torch.float32,
+        )
+    except Exception:
+        logger.exception("Loading %s locally failed, using the Hugging Face API", model)
         return None
 
-def query_detector(image_bytes):
+def _classify_local(pipe, image_bytes):
+    return pipe(Image.open(io.BytesIO(image_bytes)), top_k=5)
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+# Single inference kernel for every model. The cache key is (model, digest), so each
+# model is memoized independently. Failures raise and are never cached.
+# The leading underscore keeps Streamlit from hashing the payload itself; callers
+# pass its blake2b digest (see _digest) as the key instead.
+@st.cache_data(ttl=3600, max_entries=128, show_spinner=False)
+def classify(model: str, digest: str, _image_bytes: bytes) -> list:
+    pipe = get_pipeline(model)
+    if pipe is not None:
+        try:
+            return _classify_local(pipe, _image_bytes)
+        except Exception:
+            logger.exception("Local inference with %s failed, falling back to the API", model)
+
+    token = hf_token()
+    if not token:
+        raise MissingTokenError(TOKEN_MISSING_MESSAGE)
+
+    response = get_session().post(
+        api_url(model),
+        headers={"Authorization": f"Bearer {token}"},
+        data=_image_bytes,
+        timeout=(5, 60),
+    )
+    response.raise_for_status()
+
+    # Check content-type to ensure it's JSON
+    if "application/json" not in response.headers.get("Content-Type", ""):
+        raise NonJSONResponse(response.text)
     try:
-        response = requests.post(API_URL_DETECTOR, headers=headers, data=image_bytes)
-        response.raise_for_status()
+        result = response.json()
+    except ValueError:
+        raise NonJSONResponse(response.text)
+
+    # Reject anything else (e.g. {"error": ...}) so it is never cached
+    if not _is_classification(result):
+        raise UnexpectedResponse(response.text)
+    return result
+
+# Process-wide cap on concurrent classify() calls, shared by every session,
+# so concurrent users can't trigger a burst of 429s
+API_CONCURRENCY = 8
+
+# One event loop on a background thread, shared by every session and rerun.
+# classify() only runs on its executor, whose size enforces API_CONCURRENCY.
+@st.cache_resource
+def get_event_loop():
+    loop = asyncio.new_event_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=API_CONCURRENCY))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+def run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+# Score above which the detector's "artificial" label flags an image as generated
+ARTIFICIAL_THRESHOLD = 0.20
+
+async def _gather(jobs):
+    return await asyncio.gather(
+        *(asyncio.to_thread(classify, model, _digest(data), data) for model, data in jobs),
+        return_exceptions=True,
+    )
 
-        # Check content-type to ensure it's JSON
-        if "application/json" not in response.headers.get("Content-Type", ""):
-            st.error("API did not return JSON. Raw response:")
-            st.text(response.text)
-            return None
+def _report_error(err):
+    if isinstance(err, MissingTokenError):
+        st.error(str(err))
+    elif isinstance(err, NonJSONResponse):
+        st.error("API did not return JSON. Raw response:")
+        st.text(err.text)
+    elif isinstance(err, UnexpectedResponse):
+        st.error("API returned an unexpected response:")
+        st.text(err.text)
+    elif isinstance(err, requests.exceptions.HTTPError):
+        st.error(f"HTTP error occurred: {err}")
+        if err.response is not None and err.response.text:
+            st.text(err.response.text)
+    elif isinstance(err, requests.exceptions.RequestException):
+        st.error(f"Request failed: {err}")
+    elif isinstance(err, UnidentifiedImageError):
+        st.error("The uploaded file could not be read as an image.")
+    else:
+        st.error(f"Classification failed: {err}")
+
+def _try_prepare_payload(uploaded_file):
+    # A corrupt or misnamed upload only fails its own result, not the whole page
+    try:
+        return _prepare_payload(uploaded_file.getvalue())
+    except Exception as err:
+        _report_error(err)
+        return None
 
-        return response.json()
+def classify_many(jobs):
+    # Runs classify() for every (model, payload) job concurrently; failures become None
+    # Load the models up front so worker threads don't race to download them
+    for model in {model for model, _ in jobs}:
+        get_pipeline(model)
 
-    except requests.exceptions.HTTPError as http_err:
-        st.error(f"HTTP error occurred: {http_err}")
-    except requests.exceptions.RequestException as req_err:
-        st.error(f"Request failed: {req_err}")
-    except ValueError:
-        st.error("Response is not valid JSON:")
-        st.text(response.text)
+    results = run_async(_gather(jobs))
 
-    return None
+    for i, result in enumerate(results):
+        if isinstance(result, Exception):
+            _report_error(result)
+            results[i] = None
+    return results
 
 
-def age_classification():
-    st.title("Age Classification")
+def render_age(result):
+    st.write("API Response:")
+    st.table(result)
 
-    # Upload an image
-    uploaded_file = st.file_uploader("Choose an image...", type=["jpg", "jpeg", "png"])
+    # Determine the label with the highest score
+    top_result = max(result, key=itemgetter('score'))
+    st.write(f"The person in the image is likely in the age group: **{top_result['label']}** (score: {top_result['score']:.2f})")
 
-    if uploaded_file is not None:
-        image = Image.open(uploaded_file)
-        st.image(image, caption='Uploaded Image.', use_column_width=True)
+def render_detector(result):
+    st.write("API Response:")
+    st.table(result)
 
-        if not HF_TOKEN:
-            st.error("Hugging Face API token not found! Please set HUGGINGFACE_API_KEY in your .env file.")
-            return
+    # Determine the label with the highest score
+    top_result = max(result, key=itemgetter('score'))
+    st.write(f"The image is likely **{top_result['label']}** with a score of {top_result['score']:.2f}.")
 
-        # Call the Hugging Face API
-        with st.spinner('Classifying...'):
-            result = query_age(image)
+def render_artificial(result):
+    # Determine the likelihood based on the scores
+    scores = {item['label']: item['score'] for item in result}
+    is_artificial = scores.get('artificial', 0.0) > ARTIFICIAL_THRESHOLD
 
-        # Display API response
-        if result and isinstance(result, list) and len(result) > 0:
-            df = pd.DataFrame(result)
-            st.write("API Response:")
-            st.table(df)
+    if is_artificial:
+        st.write("The image may be artificially generated.")
+    else:
+        st.write("The image is likely human.")
 
-            # Determine the label with the highest score
-            top_result = df.loc[df['score'].idxmax()]
-            label = top_result['label']
-            st.write(f"The person in the image is likely in the age group: **{label}** (score: {top_result['score']:.2f})")
-        else:
-            st.write("An error occurred while processing the image. Please try again.")
+def _has_token(models):
+    # Local models need no token; it is only required when the API will be used
+    if all(get_pipeline(model) is not None for model in models):
+        return True
+    if not hf_token():
+        st.error(TOKEN_MISSING_MESSAGE)
+        return False
+    return True
 
-def ai_image_detector():
-    st.title("AI Image Detector")
+def classifier_page(title, model, render, spinner='Analyzing...'):
+    st.title(title)
 
-    # Upload an image
-    uploaded_file = st.file_uploader("Choose an image...", type=["jpg", "jpeg", "png"])
+    # Upload one or more images
+    uploaded_files = st.file_uploader("Choose images...", type=["jpg", "jpeg", "png"], accept_multiple_files=True)
 
-    if uploaded_file is not None:
-        # Display the uploaded image
-        st.image(uploaded_file, caption='Uploaded Image.', use_container_width=True)
+    if uploaded_files:
+        if not _has_token([model]):
+            return
 
-        # Convert image to bytes
-        image_bytes = uploaded_file.read()
+        # Convert images to downscaled JPEG payloads and call the model
+        with st.spinner(spinner):
+            payloads = [_try_prepare_payload(f) for f in uploaded_files]
+            classified = iter(classify_many([(model, p) for p in payloads if p is not None]))
+            results = [next(classified) if p is not None else None for p in payloads]
 
-        # Call the Hugging Face API
-        with st.spinner('Analyzing...'):
-            result = query_detector(image_bytes)
-
-        # Check and display the result
-        if result:
-            # Convert result to DataFrame for table display
-            df = pd.DataFrame(result)
-            st.write("API Response:")
-            st.table(df)
-
-            # Determine the label with the highest score
-            if not df.empty:
-                top_result = df.loc[df['score'].idxmax()]
-                label = top_result['label']
-                st.write(f"The image is likely **{label}** with a score of {top_result['score']:.2f}.")
+        for uploaded_file, payload, result in zip(uploaded_files, payloads, results):
+            # Don't hand a file Pillow couldn't read to st.image
+            if payload is None:
+                st.write(f"**{uploaded_file.name}**")
             else:
-                st.write("No results to display.")
-        else:
-            st.write("Failed to get a valid response from the API.")
+                st.image(uploaded_file, caption=uploaded_file.name, use_container_width=True)
+
+            if result:
+                render(result)
+            else:
+                st.write("Failed to get a valid response from the API.")
+
+def age_classification():
+    classifier_page("Age Classification", AGE_MODEL, render_age, spinner='Classifying...')
+
+def ai_image_detector():
+    classifier_page("AI Image Detector", DETECTOR_MODEL, render_detector)
 
 def is_artificial_detector():
-    st.title("Is Image Artificial?")
+    classifier_page("Is Image Artificial?", DETECTOR_MODEL, render_artificial)
+
+def combined_analysis():
+    st.title("Age + AI Detection")
 
     # Upload an image
     uploaded_file = st.file_uploader("Choose an image...", type=["jpg", "jpeg", "png"])
 
     if uploaded_file is not None:
-        # Display the uploaded image
-        st.image(uploaded_file, caption='Uploaded Image.', use_column_width=True)
+        jpeg_bytes = _try_prepare_payload(uploaded_file)
+        if jpeg_bytes is None:
+            st.write("Failed to get a valid response from the API.")
+            return
+
+        st.image(uploaded_file, caption='Uploaded Image.', use_container_width=True)
+
+        if not _has_token([AGE_MODEL, DETECTOR_MODEL]):
+            return
 
-        # Convert image to bytes
-        image_bytes = uploaded_file.read()
+        # Call both models at once on the same payload
 
-        # Call the Hugging Face API
         with st.spinner('Analyzing...'):
-            result = query_detector(image_bytes)
-
-        # Check and display the result
-        if result:
-            # Determine the likelihood based on the scores
-            is_artificial = False
-            for item in result:
-                if item['label'] == 'artificial' and item['score'] > 0.20:
-                    is_artificial = True
-                    break
-
-            if is_artificial:
-                st.write("The image may be artificially generated.")
-            else:
-                st.write("The image is likely human.")
+            age_result, detector_result = classify_many([(AGE_MODEL, jpeg_bytes), (DETECTOR_MODEL, jpeg_bytes)])
+
+        st.subheader("Age")
+        if age_result:
+            render_age(age_result)
         else:
-            st.write("Failed to get a valid response from the API.")
+            st.write("Age classification failed.")
+
+        st.subheader("AI Detection")
+        if detector_result:
+            render_detector(detector_result)
+        else:
+            st.write("AI image detection failed.")
 
 def main():
     st.set_page_config(page_title="AI Image Tools", page_icon=":robot:")
 
     st.sidebar.title("Navigation")
-    selection = st.sidebar.radio("Go to", ["Age Classification", "AI Image Detector", "Is Image Artificial?"])
+    selection = st.sidebar.radio("Go to", ["Age Classification", "AI Image Detector", "Is Image Artificial?", "Age + AI Detection"])
+
+    if st.sidebar.button("Clear cache"):
+        classify.clear()
 
     if selection == "Age Classification":
         age_classification()
@@ -172,6 +397,8 @@ def main():
         ai_image_detector()
     elif selection == "Is Image Artificial?":
         is_artificial_detector()
+    elif selection == "Age + AI Detection":
+        combined_analysis()
 
 if __name__ == "__main__":
     main()